@@ -3,6 +3,8 @@ import datetime
 import csv
 import os
 import json
+import hashlib
+import functools
 import random
 
 def load_rules(json_filepath):
@@ -10,13 +12,34 @@ def load_rules(json_filepath):
         rules = json.load(f)
     required_rules = rules["Rules"]["required"]
     preferred_rules = rules["Rules"].get("preferred", {})
-    return required_rules, preferred_rules
+    return required_rules, preferred_rules, rules
 
 def load_temporary_rules(json_filepath):
     with open(json_filepath, "r") as f:
         temp_rules = json.load(f)
     return temp_rules
 
+def apply_solver_overrides(solver, json_filepath):
+    # Optional CP-SAT parameter overrides, e.g. {"random_seed": 1, "search_branching": "PORTFOLIO_SEARCH"}.
+    # Values go through the text format so enum fields accept their names.
+    if not os.path.exists(json_filepath):
+        return
+    with open(json_filepath, "r") as f:
+        overrides = json.load(f)
+    if not isinstance(overrides, dict):
+        raise SystemExit(f"{os.path.basename(json_filepath)}: expected an object mapping solver parameter names to values.")
+    for name, value in overrides.items():
+        if not hasattr(solver.parameters, name):
+            raise SystemExit(f"{os.path.basename(json_filepath)}: unknown solver parameter '{name}'.")
+        if isinstance(value, bool):
+            text = "true" if value else "false"
+        elif isinstance(getattr(solver.parameters, name), str):
+            text = json.dumps(value)
+        else:
+            text = str(value)
+        if not solver.parameters.merge_text_format(f"{name}: {text}"):
+            raise SystemExit(f"{os.path.basename(json_filepath)}: invalid value {value!r} for solver parameter '{name}'.")
+
 def load_last_rota(output_dir):
     import glob, re
     rota_files = glob.glob(os.path.join(output_dir, "Rota - *.csv"))
@@ -73,360 +96,510 @@ day_name_to_index = {
     "Saturday": 6
 }
 
+def get_allowed_shifts(required_rules, employees, shift_to_int):
+    allowed_shifts_by_emp = {}
+    for emp in employees:
+        allowed = {shift_to_int["D/O"], shift_to_int["H"]}
+        if emp in required_rules.get("Will Work Late", []):
+            allowed.add(shift_to_int["L"])
+        if emp in required_rules.get("Will Work Middle", []):
+            allowed.add(shift_to_int["M"])
+        if emp in required_rules.get("Will work Early", []):
+            allowed.add(shift_to_int["E"])
+        allowed_shifts_by_emp[emp] = allowed
+    return allowed_shifts_by_emp
+
 # Domain: 0 = Early, 1 = Middle, 2 = Late, 3 = Day Off (D/O), 4 = Holiday (H)
-def initialize_model(num_weeks, days_per_week, employees, shift_to_int):
+# Each cell is one-hot encoded: is_shift[w, d, e, s] is true when employee e
+# works shift s on day d of week w. Shifts an employee will never work are
+# fixed to the constant 0 rather than created as variables. x[w, d, e] is the
+# equivalent integer expression, kept for reading the solution back out.
+# work[w, d, e] is 1 on any E/M/L shift; it is a plain sum of the indicators
+# rather than its own variable, since every use of it is inside a linear sum.
+def initialize_model(num_weeks, days_per_week, employees, shift_to_int, allowed_shifts_by_emp):
     model = cp_model.CpModel()
     x = {}
-    num_employees = len(employees)
-    for w in range(num_weeks):
-        for d in range(days_per_week):
-            for e in range(num_employees):
-                x[w, d, e] = model.NewIntVar(0, 4, f"x[{w},{d},{e}]")
-    return model, x
+    is_shift = {}
+    work = {}
+    shift_values = list(shift_to_int.values())
+    working_values = [shift_to_int["E"], shift_to_int["M"], shift_to_int["L"]]
+    for e, emp in enumerate(employees):
+        allowed = allowed_shifts_by_emp[emp]
+        for w in range(num_weeks):
+            for d in range(days_per_week):
+                # Build the cell's indicators as a list first so the constraints
+                # below reuse it instead of re-reading the dict.
+                cell = [model.NewBoolVar(f"is_shift[{w},{d},{e},{s}]") if s in allowed else model.NewConstant(0)
+                        for s in shift_values]
+                for s, indicator in zip(shift_values, cell):
+                    is_shift[w, d, e, s] = indicator
+                model.AddExactlyOne(cell)
+                x[w, d, e] = cp_model.LinearExpr.WeightedSum(cell, shift_values)
+                work[w, d, e] = cp_model.LinearExpr.Sum([is_shift[w, d, e, s] for s in working_values])
+    return model, x, is_shift, work
 
-def add_allowed_shifts(model, required_rules, employees, shift_to_int, x, num_weeks, days_per_week):
-    for w in range(num_weeks):
-        for d in range(days_per_week):
-            for e, emp in enumerate(employees):
-                allowed = set()
-                if emp in required_rules.get("Will Work Late", []):
-                    allowed.add(shift_to_int["L"])
-                if emp in required_rules.get("Will Work Middle", []):
-                    allowed.add(shift_to_int["M"])
-                if emp in required_rules.get("Will work Early", []):
-                    allowed.add(shift_to_int["E"])
-                for shift in ["E", "M", "L"]:
-                    if shift_to_int[shift] not in allowed:
-                        model.Add(x[w, d, e] != shift_to_int[shift])
-
-def enforce_strict_alternating_weekends(model, x, shift_to_int, num_weeks, days_per_week, employees, alt_emps, weekend_offsets):
+def enforce_strict_alternating_weekends(model, is_shift, shift_to_int, num_weeks, days_per_week, emp_to_idx, alt_emps, weekend_offsets):
+    day_off = shift_to_int["D/O"]
     for emp in alt_emps:
-        e = employees.index(emp)
+        e = emp_to_idx[emp]
         offset = weekend_offsets.get(emp, 0)
         for w in range(num_weeks - 1):
             if (w + offset) % 2 == 0:
                 # Enforce weekend off for this adjusted week
-                model.Add(x[w, days_per_week - 1, e] == shift_to_int["D/O"])  # Saturday
-                model.Add(x[w + 1, 0, e] == shift_to_int["D/O"])               # Sunday of next week
+                model.Add(is_shift[w, days_per_week - 1, e, day_off] == 1)  # Saturday
+                model.Add(is_shift[w + 1, 0, e, day_off] == 1)               # Sunday of next week
             else:
-                model.Add(x[w, days_per_week - 1, e] != shift_to_int["D/O"])
-                model.Add(x[w + 1, 0, e] != shift_to_int["D/O"])
+                model.Add(is_shift[w, days_per_week - 1, e, day_off] == 0)
+                model.Add(is_shift[w + 1, 0, e, day_off] == 0)
 
-def add_daily_coverage_constraints(model, x, shift_to_int, num_weeks, days_per_week, employees):
+def add_daily_coverage_constraints(model, is_shift, work, shift_to_int, num_weeks, days_per_week, employees):
     num_employees = len(employees)
+    early = shift_to_int["E"]
+    middle = shift_to_int["M"]
+    late = shift_to_int["L"]
     for w in range(num_weeks):
         for d in range(days_per_week):
-            early_vars = []
-            late_vars = []
-            working_vars = []
-            for e in range(num_employees):
-                is_working = model.NewBoolVar(f"working_{w}_{d}_{e}")
-                model.Add(x[w, d, e] <= shift_to_int["L"]).OnlyEnforceIf(is_working)
-                model.Add(x[w, d, e] > shift_to_int["L"]).OnlyEnforceIf(is_working.Not())
-                working_vars.append(is_working)
-                
-                b_early = model.NewBoolVar(f"early_{w}_{d}_{e}")
-                model.Add(x[w, d, e] == shift_to_int["E"]).OnlyEnforceIf(b_early)
-                model.Add(x[w, d, e] != shift_to_int["E"]).OnlyEnforceIf(b_early.Not())
-                early_vars.append(b_early)
-                
-                b_late = model.NewBoolVar(f"late_{w}_{d}_{e}")
-                model.Add(x[w, d, e] == shift_to_int["L"]).OnlyEnforceIf(b_late)
-                model.Add(x[w, d, e] != shift_to_int["L"]).OnlyEnforceIf(b_late.Not())
-                late_vars.append(b_late)
-                
-                # No Middle on weekends
-                if d == 0 or d == days_per_week - 1:
-                    model.Add(x[w, d, e] != shift_to_int["M"])
-            model.Add(sum(early_vars) >= 1)
-            model.Add(sum(late_vars) >= 1)
-            model.Add(sum(working_vars) <= 4)
-
-def add_reserve_priority(model, x, shift_to_int, num_weeks, days_per_week, employees, reserve_employees):
+            # At least one Early and one Late each day, as plain clauses.
+            model.AddBoolOr([is_shift[w, d, e, early] for e in range(num_employees)])
+            model.AddBoolOr([is_shift[w, d, e, late] for e in range(num_employees)])
+            model.Add(cp_model.LinearExpr.Sum([work[w, d, e] for e in range(num_employees)]) <= 4)
+            # No Middle on weekends
+            if d == 0 or d == days_per_week - 1:
+                for e in range(num_employees):
+                    model.Add(is_shift[w, d, e, middle] == 0)
+
+def add_reserve_priority(model, is_shift, shift_to_int, num_weeks, days_per_week, employees, reserve_employees):
     num_employees = len(employees)
     # Identify indices for employees who are NOT reserves (the duty managers)
-    non_reserve_indices = [i for i, emp in enumerate(employees) if emp not in reserve_employees]
+    non_reserve_indices = {i for i, emp in enumerate(employees) if emp not in reserve_employees}
+    working_values = [shift_to_int["E"], shift_to_int["M"], shift_to_int["L"]]
     
     for w in range(num_weeks):
         for d in range(days_per_week):
-            for shift in ["E", "M", "L"]:
+            for s in working_values:
                 non_reserve_bools = []
                 reserve_bools = []
                 for e in range(num_employees):
-                    b = model.NewBoolVar(f"cover_{shift}_{w}_{d}_{e}")
-                    model.Add(x[w, d, e] == shift_to_int[shift]).OnlyEnforceIf(b)
-                    model.Add(x[w, d, e] != shift_to_int[shift]).OnlyEnforceIf(b.Not())
+                    b = is_shift[w, d, e, s]
                     if e in non_reserve_indices:
                         non_reserve_bools.append(b)
                     else:
                         reserve_bools.append(b)
                         
-                # Set up sum variables over booleans with appropriate domains.
-                non_reserve_sum = model.NewIntVar(0, len(non_reserve_bools), f"nonres_{shift}_{w}_{d}")
-                reserve_sum = model.NewIntVar(0, len(reserve_bools), f"res_{shift}_{w}_{d}")
-                model.Add(non_reserve_sum == sum(non_reserve_bools))
-                model.Add(reserve_sum == sum(reserve_bools))
-                
-                # Create a helper Boolean that is true if any non-reserve (duty manager) is assigned.
-                non_reserve_present = model.NewBoolVar(f"non_reserve_present_{shift}_{w}_{d}")
-                model.Add(non_reserve_sum >= 1).OnlyEnforceIf(non_reserve_present)
-                model.Add(non_reserve_sum == 0).OnlyEnforceIf(non_reserve_present.Not())
-                
-                # Enforce that if any duty manager is covering the shift, then no reserve is allowed.
-                model.Add(reserve_sum == 0).OnlyEnforceIf(non_reserve_present)
-
-def add_employee_specific_constraints(model, required_rules, employees, day_name_to_index, shift_to_int, x, num_weeks, days_per_week, duty_managers, reserve_employees):
+                # A reserve may only take the shift when no duty manager is on it.
+                for reserve_bool in reserve_bools:
+                    model.Add(cp_model.LinearExpr.Sum(non_reserve_bools) == 0).OnlyEnforceIf(reserve_bool)
+
+def add_employee_specific_constraints(model, required_rules, employees, emp_to_idx, day_name_to_index, shift_to_int, is_shift, work, num_weeks, days_per_week, duty_managers, reserve_employees):
     # Enforce "Working Days" exactly for duty managers and at most for reserves.
     if "Working Days" in required_rules:
         for e, emp in enumerate(employees):
             if emp in required_rules["Working Days"]:
                 required_days = required_rules["Working Days"][emp]
+                # Reserves work at most their days; everyone else works exactly that many.
+                is_reserve_only = emp not in duty_managers and emp in reserve_employees
                 for w in range(num_weeks):
-                    work_vars = []
-                    for d in range(days_per_week):
-                        is_working = model.NewBoolVar(f"emp_working_{emp}_{w}_{d}")
-                        model.Add(x[w, d, e] <= shift_to_int["L"]).OnlyEnforceIf(is_working)
-                        model.Add(x[w, d, e] > shift_to_int["L"]).OnlyEnforceIf(is_working.Not())
-                        work_vars.append(is_working)
-                    if emp in duty_managers:
-                        model.Add(sum(work_vars) == required_days)
-                    elif emp in reserve_employees:
-                        model.Add(sum(work_vars) <= required_days)
+                    work_vars = [work[w, d, e] for d in range(days_per_week)]
+                    if is_reserve_only:
+                        model.Add(cp_model.LinearExpr.Sum(work_vars) <= required_days)
                     else:
-                        model.Add(sum(work_vars) == required_days)
+                        model.Add(cp_model.LinearExpr.Sum(work_vars) == required_days)
     if "Days won't work" in required_rules:
         for emp, day in required_rules["Days won't work"].items():
-            if emp in employees:
-                e = employees.index(emp)
+            if emp in emp_to_idx:
+                e = emp_to_idx[emp]
                 d_idx = day_name_to_index[day]
+                day_off = shift_to_int["D/O"]
                 for w in range(num_weeks):
-                    model.Add(x[w, d_idx, e] == shift_to_int["D/O"])
+                    model.Add(is_shift[w, d_idx, e, day_off] == 1)
 
-def add_temporary_constraints(model, x, employees, temporary_rules, num_weeks, days_per_week, shift_to_int):
+def add_redundant_weekly_totals(model, required_rules, employees, work, num_weeks, days_per_week, duty_managers, reserve_employees):
+    # Redundant view of the "Working Days" rule: the total number of shifts in
+    # each week is the fixed duty manager days plus however many days the
+    # reserves are used. Implied by the per-employee sums, but gives the
+    # solver a week-level bound to propagate on.
+    working_days = required_rules.get("Working Days", {})
+    if not all(emp in working_days for emp in employees):
+        return
+    fixed_days = sum(working_days[emp] for emp in employees if emp in duty_managers or emp not in reserve_employees)
+    reserve_indices = [e for e, emp in enumerate(employees) if emp not in duty_managers and emp in reserve_employees]
+    # Daily coverage puts between 2 (one Early, one Late) and 4 staff on each
+    # day, which bounds how many days the reserves can fill in a week.
+    reserve_min = max(0, 2 * days_per_week - fixed_days)
+    reserve_max = min(sum(working_days[employees[e]] for e in reserve_indices), 4 * days_per_week - fixed_days)
+    if reserve_min > reserve_max:
+        # The rules cannot be met; keep a valid range so the solver reports infeasibility.
+        reserve_min, reserve_max = 0, max(0, reserve_max)
+    for w in range(num_weeks):
+        reserve_week = model.NewIntVar(reserve_min, reserve_max, f"reserve_week_{w}")
+        model.Add(reserve_week == cp_model.LinearExpr.Sum([work[w, d, e] for d in range(days_per_week) for e in reserve_indices]))
+        model.Add(cp_model.LinearExpr.Sum([work[w, d, e] for d in range(days_per_week) for e in range(len(employees))]) == fixed_days + reserve_week)
+
+@functools.lru_cache(maxsize=None)
+def parse_rule_date(date_str):
+    return datetime.datetime.strptime(date_str, "%Y/%m/%d").date()
+
+def add_temporary_constraints(model, is_shift, employees, emp_to_idx, temporary_rules, num_weeks, days_per_week, shift_to_int):
     global_temp = temporary_rules["Required"].get("Everyone", {})
     rota_start_str = global_temp.get("Start Date", "")
     if rota_start_str:
-        rota_start = datetime.datetime.strptime(rota_start_str, "%Y/%m/%d")
+        rota_start = parse_rule_date(rota_start_str)
     else:
-        rota_start = datetime.datetime.today()
+        rota_start = datetime.date.today()
+    total_days = num_weeks * days_per_week
+    # A date's cell is its day offset from the rota start, so every rule is O(1).
+    # Forced cells fix their shift indicator directly, which presolve turns into constants.
     for emp in employees:
         if emp in temporary_rules["Required"]:
             emp_rules = temporary_rules["Required"][emp]
-            e = employees.index(emp)
+            e = emp_to_idx[emp]
             days_off = emp_rules.get("days off", [])
             for day_str in days_off:
                 if day_str:
-                    off_date = datetime.datetime.strptime(day_str, "%Y/%m/%d")
-                    for w in range(num_weeks):
-                        for d in range(days_per_week):
-                            current_date = rota_start + datetime.timedelta(days=w*days_per_week + d)
-                            if current_date.date() == off_date.date():
-                                model.Add(x[w, d, e] == shift_to_int["D/O"])
-            for shift_field in ["Early", "Middle", "Late"]:
+                    offset = (parse_rule_date(day_str) - rota_start).days
+                    if 0 <= offset < total_days:
+                        w, d = divmod(offset, days_per_week)
+                        model.Add(is_shift[w, d, e, shift_to_int["D/O"]] == 1)
+            for shift_field, shift in [("Early", "E"), ("Middle", "M"), ("Late", "L")]:
                 req_date_str = emp_rules.get(shift_field, "")
                 if req_date_str:
-                    req_date = datetime.datetime.strptime(req_date_str, "%Y/%m/%d")
-                    for w in range(num_weeks):
-                        for d in range(days_per_week):
-                            current_date = rota_start + datetime.timedelta(days=w*days_per_week + d)
-                            if current_date.date() == req_date.date():
-                                if shift_field == "Early":
-                                    model.Add(x[w, d, e] == shift_to_int["E"])
-                                elif shift_field == "Middle":
-                                    model.Add(x[w, d, e] == shift_to_int["M"])
-                                elif shift_field == "Late":
-                                    model.Add(x[w, d, e] == shift_to_int["L"])
+                    offset = (parse_rule_date(req_date_str) - rota_start).days
+                    if 0 <= offset < total_days:
+                        w, d = divmod(offset, days_per_week)
+                        model.Add(is_shift[w, d, e, shift_to_int[shift]] == 1)
             holiday = emp_rules.get("holiday", {})
             if holiday.get("active", False):
                 start_hol = holiday.get("start", "")
                 end_hol = holiday.get("end", "")
                 if start_hol and end_hol:
-                    hol_start = datetime.datetime.strptime(start_hol, "%Y/%m/%d")
-                    hol_end = datetime.datetime.strptime(end_hol, "%Y/%m/%d")
-                    for w in range(num_weeks):
-                        for d in range(days_per_week):
-                            current_date = rota_start + datetime.timedelta(days=w*days_per_week + d)
-                            if hol_start.date() <= current_date.date() <= hol_end.date():
-                                model.Add(x[w, d, e] == shift_to_int["H"])
-
-def add_no_late_to_early_constraint(model, x, shift_to_int, num_weeks, days_per_week, employees):
+                    # Clip the holiday to the rota and walk only the days it covers.
+                    first = max(0, (parse_rule_date(start_hol) - rota_start).days)
+                    last = min(total_days - 1, (parse_rule_date(end_hol) - rota_start).days)
+                    for i in range(first, last + 1):
+                        w, d = divmod(i, days_per_week)
+                        model.Add(is_shift[w, d, e, shift_to_int["H"]] == 1)
+
+def add_no_late_to_early_constraint(model, is_shift, shift_to_int, num_weeks, days_per_week, employees):
     num_employees = len(employees)
-    for w in range(num_weeks):
-        for d in range(days_per_week - 1):
-            for e in range(num_employees):
-                was_late = model.NewBoolVar(f"late_{w}_{d}_{e}")
-                model.Add(x[w, d, e] == shift_to_int["L"]).OnlyEnforceIf(was_late)
-                model.Add(x[w, d, e] != shift_to_int["L"]).OnlyEnforceIf(was_late.Not())
-                model.Add(x[w, d+1, e] != shift_to_int["E"]).OnlyEnforceIf(was_late)
-    for w in range(num_weeks - 1):
+    late = shift_to_int["L"]
+    early = shift_to_int["E"]
+    # Walk consecutive day pairs across the whole rota, including week boundaries.
+    for t in range(num_weeks * days_per_week - 1):
+        w, d = divmod(t, days_per_week)
+        w_next, d_next = divmod(t + 1, days_per_week)
         for e in range(num_employees):
-            was_late = model.NewBoolVar(f"late_{w}_{days_per_week-1}_{e}")
-            model.Add(x[w, days_per_week-1, e] == shift_to_int["L"]).OnlyEnforceIf(was_late)
-            model.Add(x[w, days_per_week-1, e] != shift_to_int["L"]).OnlyEnforceIf(was_late.Not())
-            model.Add(x[w+1, 0, e] != shift_to_int["E"]).OnlyEnforceIf(was_late)
+            model.AddBoolOr([is_shift[w, d, e, late].Not(), is_shift[w_next, d_next, e, early].Not()])
 
-def add_objective(model, x, shift_to_int, num_weeks, days_per_week, employees, preferred_rules, alternating_employees):
-    objective_terms = []
+def add_objective(model, is_shift, shift_to_int, num_weeks, days_per_week, employees, emp_to_idx, preferred_rules, alternating_employees):
+    objective_vars = []
+    objective_coeffs = []
     weekend_bonus_full = 5000
     weekend_bonus_partial = 2500
+    # Alternating employees have fixed weekends, so they earn no weekend bonus.
+    bonus_indices = [e for e, emp in enumerate(employees) if emp not in alternating_employees]
+    # A partial weekend is sat_off + sun_off - 2 * full_weekend, so its bonus is
+    # folded into the per-day and full-weekend coefficients. With the full bonus
+    # worth exactly two partials the full-weekend term vanishes and no extra
+    # variable is needed.
+    full_weekend_coeff = weekend_bonus_full - 2 * weekend_bonus_partial
+    day_off = shift_to_int["D/O"]
     for w in range(num_weeks):
-        for e, emp in enumerate(employees):
-            if emp in alternating_employees:
-                continue
-            sat_off = model.NewBoolVar(f"sat_off_{w}_{e}")
-            sun_off = model.NewBoolVar(f"sun_off_{w}_{e}")
-            model.Add(x[w, days_per_week - 1, e] == shift_to_int["D/O"]).OnlyEnforceIf(sat_off)
-            model.Add(x[w, days_per_week - 1, e] != shift_to_int["D/O"]).OnlyEnforceIf(sat_off.Not())
-            model.Add(x[w, 0, e] == shift_to_int["D/O"]).OnlyEnforceIf(sun_off)
-            model.Add(x[w, 0, e] != shift_to_int["D/O"]).OnlyEnforceIf(sun_off.Not())
-            full_weekend = model.NewBoolVar(f"full_weekend_{w}_{e}")
-            model.AddBoolAnd([sat_off, sun_off]).OnlyEnforceIf(full_weekend)
-            model.AddBoolOr([sat_off.Not(), sun_off.Not()]).OnlyEnforceIf(full_weekend.Not())
-            partial_weekend = model.NewBoolVar(f"partial_weekend_{w}_{e}")
-            model.Add(sat_off + sun_off == 1).OnlyEnforceIf(partial_weekend)
-            model.Add(sat_off + sun_off != 1).OnlyEnforceIf(partial_weekend.Not())
-            objective_terms.append(full_weekend * weekend_bonus_full)
-            objective_terms.append(partial_weekend * weekend_bonus_partial)
+        for e in bonus_indices:
+            sat_off = is_shift[w, days_per_week - 1, e, day_off]
+            sun_off = is_shift[w, 0, e, day_off]
+            objective_vars += [sat_off, sun_off]
+            objective_coeffs += [weekend_bonus_partial, weekend_bonus_partial]
+            if full_weekend_coeff:
+                full_weekend = model.NewBoolVar(f"full_weekend_{w}_{e}")
+                model.Add(full_weekend <= sat_off)
+                model.Add(full_weekend <= sun_off)
+                model.Add(full_weekend >= sat_off + sun_off - 1)
+                objective_vars.append(full_weekend)
+                objective_coeffs.append(full_weekend_coeff)
     pref_weight = 2000
-    for w in range(num_weeks):
-        for d in range(days_per_week):
-            for e, emp in enumerate(employees):
-                if "Late Shifts" in preferred_rules and emp in preferred_rules["Late Shifts"]:
-                    b = model.NewBoolVar(f"pref_late_{w}_{d}_{e}")
-                    model.Add(x[w, d, e] == shift_to_int["L"]).OnlyEnforceIf(b)
-                    model.Add(x[w, d, e] != shift_to_int["L"]).OnlyEnforceIf(b.Not())
-                    objective_terms.append(b * pref_weight)
-                if "Early Shifts" in preferred_rules and emp in preferred_rules["Early Shifts"]:
-                    b = model.NewBoolVar(f"pref_early_{w}_{d}_{e}")
-                    model.Add(x[w, d, e] == shift_to_int["E"]).OnlyEnforceIf(b)
-                    model.Add(x[w, d, e] != shift_to_int["E"]).OnlyEnforceIf(b.Not())
-                    objective_terms.append(b * pref_weight)
-                if "Middle Shifts" in preferred_rules and emp in preferred_rules["Middle Shifts"]:
-                    b = model.NewBoolVar(f"pref_mid_{w}_{d}_{e}")
-                    model.Add(x[w, d, e] == shift_to_int["M"]).OnlyEnforceIf(b)
-                    model.Add(x[w, d, e] != shift_to_int["M"]).OnlyEnforceIf(b.Not())
-                    objective_terms.append(b * pref_weight)
-    model.Maximize(sum(objective_terms))
+    preferred_shift_keys = {"Late Shifts": "L", "Early Shifts": "E", "Middle Shifts": "M"}
+    for pref_key, shift in preferred_shift_keys.items():
+        s = shift_to_int[shift]
+        # A name listed twice still earns the bonus once.
+        for emp in dict.fromkeys(preferred_rules.get(pref_key, [])):
+            if emp not in emp_to_idx:
+                continue
+            e = emp_to_idx[emp]
+            for w in range(num_weeks):
+                for d in range(days_per_week):
+                    objective_vars.append(is_shift[w, d, e, s])
+                    objective_coeffs.append(pref_weight)
+    model.Maximize(cp_model.LinearExpr.WeightedSum(objective_vars, objective_coeffs))
 
-num_weeks = 4
-days_per_week = 7
-script_dir = os.path.dirname(os.path.abspath(__file__))
+def find_interchangeable_groups(employees, required_rules, preferred_rules, temporary_rules, previous_state, duty_managers, reserve_employees, alternating_employees):
+    # Employees whose every rule is identical can swap schedules without
+    # changing feasibility or the objective, so they are grouped together.
+    groups = {}
+    for e, emp in enumerate(employees):
+        rule_view = {}
+        for rules in (required_rules, preferred_rules):
+            for key, value in rules.items():
+                if isinstance(value, dict):
+                    rule_view[key] = value.get(emp)
+                else:
+                    rule_view[key] = emp in value
+        rule_view["temporary"] = temporary_rules["Required"].get(emp)
+        rule_view["previous"] = previous_state.get(emp)
+        rule_view["reserve"] = emp in reserve_employees
+        # Duty managers work exactly their days even when also listed as reserves.
+        rule_view["duty_manager"] = emp in duty_managers
+        rule_view["alternating"] = emp in alternating_employees
+        key = hashlib.sha1(json.dumps(rule_view, sort_keys=True).encode()).hexdigest()
+        groups.setdefault(key, []).append(e)
+    return [group for group in groups.values() if len(group) > 1]
 
-rules_filepath = os.path.join(script_dir, "Rules.json")
-required_rules, preferred_rules = load_rules(rules_filepath)
-with open(rules_filepath, "r") as f:
-    rules_data = json.load(f)
-duty_managers = rules_data.get("employees-duty_manager", [])
-reserve_employees = rules_data.get("employees-duty_manager-reserve", [])
-employees = duty_managers + [emp for emp in reserve_employees if emp not in duty_managers]
+def add_symmetry_breaking(model, x, num_weeks, days_per_week, groups):
+    # Order the rota rows of interchangeable employees lexicographically.
+    for group in groups:
+        for e1, e2 in zip(group, group[1:]):
+            seq1 = [x[w, d, e1] for w in range(num_weeks) for d in range(days_per_week)]
+            seq2 = [x[w, d, e2] for w in range(num_weeks) for d in range(days_per_week)]
+            # prefix_equal[k] is forced true while the first k cells of both rows match.
+            prefix_equal = [model.NewBoolVar(f"lex_{e1}_{e2}_{k}") for k in range(len(seq1) + 1)]
+            model.Add(prefix_equal[0] == 1)
+            for k in range(len(seq1)):
+                model.Add(seq1[k] <= seq2[k]).OnlyEnforceIf(prefix_equal[k])
+                model.Add(seq1[k] != seq2[k]).OnlyEnforceIf([prefix_equal[k], prefix_equal[k + 1].Not()])
 
-alternating_employees = []
-if "Every other weekend off" in required_rules:
-    alternating_employees = required_rules["Every other weekend off"]
+def model_cache_key(script_path, inputs):
+    # The cached model is only valid for the same inputs and the same version
+    # of this script, so both go into the key.
+    with open(script_path, "rb") as f:
+        script_hash = hashlib.sha1(f.read()).hexdigest()
+    return hashlib.sha1((script_hash + json.dumps(inputs, sort_keys=True)).encode()).hexdigest()
 
-# Define the mapping between shift names and integer values.
-shift_to_int = {
-    "E": 0,    # Early
-    "M": 1,    # Middle
-    "L": 2,    # Late
-    "D/O": 3,  # Day Off
-    "H": 4     # Holiday
-}
+def save_model_cache(model, cache_path):
+    cache_dir = os.path.dirname(cache_path)
+    os.makedirs(cache_dir, exist_ok=True)
+    # The first line records a digest of the model text so a damaged file is
+    # detected on load, and the file is renamed into place only once complete.
+    text = str(model.Proto())
+    tmp_path = cache_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(f"# sha1 {hashlib.sha1(text.encode()).hexdigest()}\n")
+        f.write(text)
+    os.replace(tmp_path, cache_path)
+    # Only the current core is ever loaded, so entries for older keys are dropped.
+    for name in os.listdir(cache_dir):
+        if name.startswith("rota_core_") and os.path.join(cache_dir, name) != cache_path:
+            os.remove(os.path.join(cache_dir, name))
 
-# Inverse mapping: useful for converting the solver’s output to shift names.
-int_to_shift = {v: k for k, v in shift_to_int.items()}
+def build_core_model(num_weeks, days_per_week, employees, shift_to_int, allowed_shifts_by_emp, reserve_employees):
+    # The structural part of the model: the shift grid and the per-day rules
+    # that only depend on who is employed and which shifts they can work.
+    model, x, is_shift, work = initialize_model(num_weeks, days_per_week, employees, shift_to_int, allowed_shifts_by_emp)
+    add_daily_coverage_constraints(model, is_shift, work, shift_to_int, num_weeks, days_per_week, employees)
+    add_reserve_priority(model, is_shift, shift_to_int, num_weeks, days_per_week, employees, reserve_employees)
+    add_no_late_to_early_constraint(model, is_shift, shift_to_int, num_weeks, days_per_week, employees)
+    return model, x, is_shift, work
 
-def add_consecutive_working_constraints(model, x, shift_to_int, employees, num_weeks, days_per_week, previous_state):
-    total_days = num_weeks * days_per_week
+def load_cached_model(cache_path, num_weeks, days_per_week, employees, shift_to_int, allowed_shifts_by_emp):
+    # Returns None when the file is damaged or does not match the expected grid,
+    # so the caller rebuilds the model.
+    try:
+        with open(cache_path, "r", encoding="utf-8") as f:
+            header, _, text = f.read().partition("\n")
+    except (OSError, UnicodeDecodeError):
+        return None
+    if header != f"# sha1 {hashlib.sha1(text.encode()).hexdigest()}":
+        return None
+    model = cp_model.CpModel()
+    if not model.Proto().parse_text_format(text):
+        return None
+    # Recover the shift indicators by name so the rule constraints can be added
+    # on top. Shifts outside an employee's allowed set were built as constants,
+    # exactly as initialize_model does; every other indicator must be present.
+    index_by_name = {var.name: i for i, var in enumerate(model.Proto().variables) if var.name}
+    shift_values = list(shift_to_int.values())
+    working_values = [shift_to_int["E"], shift_to_int["M"], shift_to_int["L"]]
+    zero = model.NewConstant(0)
+    x = {}
+    is_shift = {}
     work = {}
-    consec = {}
     for e, emp in enumerate(employees):
-        init = previous_state.get(emp, {}).get("consecutive", 0)
-        for t in range(total_days):
-            w = t // days_per_week
-            d = t % days_per_week
-            work[(e, t)] = model.NewBoolVar(f"work_{emp}_{t}")
-            model.Add(x[w, d, e] <= shift_to_int["L"]).OnlyEnforceIf(work[(e, t)])
-            model.Add(x[w, d, e] >  shift_to_int["L"]).OnlyEnforceIf(work[(e, t)].Not())
-            consec[(e, t)] = model.NewIntVar(0, 6, f"consec_{emp}_{t}")
-            if t == 0:
-                model.Add(consec[(e, 0)] == init + 1).OnlyEnforceIf(work[(e, 0)])
-                model.Add(consec[(e, 0)] == 0).OnlyEnforceIf(work[(e, 0)].Not())
-            else:
-                model.Add(consec[(e, t)] == consec[(e, t-1)] + 1).OnlyEnforceIf(work[(e, t)])
-                model.Add(consec[(e, t)] == 0).OnlyEnforceIf(work[(e, t)].Not())
-            model.Add(consec[(e, t)] <= 6)
-
-model, x = initialize_model(num_weeks, days_per_week, employees, shift_to_int)
-output_dir = os.path.join(script_dir, "output")
-previous_state = load_last_rota(output_dir)
-for e, emp in enumerate(employees):
-    if previous_state.get(emp, {}).get("consecutive", 0) >= 6:
-        model.Add(x[0, 0, e] == shift_to_int["D/O"])
-
-add_allowed_shifts(model, required_rules, employees, shift_to_int, x, num_weeks, days_per_week)
-add_daily_coverage_constraints(model, x, shift_to_int, num_weeks, days_per_week, employees)
-add_reserve_priority(model, x, shift_to_int, num_weeks, days_per_week, employees, reserve_employees)
-# Enforce required working days exactly (no slack) for duty managers and at most for reserves.
-add_employee_specific_constraints(model, required_rules, employees, day_name_to_index, shift_to_int, x, num_weeks, days_per_week, duty_managers, reserve_employees)
-temp_filepath = os.path.join(script_dir, "Temporary Rules.json")
-temporary_rules = load_temporary_rules(temp_filepath)
-add_temporary_constraints(model, x, employees, temporary_rules, num_weeks, days_per_week, shift_to_int)
-weekend_offsets = {}
-for emp in alternating_employees:
-    weekend_offsets[emp] = 1 if previous_state.get(emp, {}).get("weekend_off", False) else 0
-if alternating_employees:
-    enforce_strict_alternating_weekends(model, x, shift_to_int, num_weeks, days_per_week, employees, alternating_employees, weekend_offsets)
-add_no_late_to_early_constraint(model, x, shift_to_int, num_weeks, days_per_week, employees)
-add_objective(model, x, shift_to_int, num_weeks, days_per_week, employees, preferred_rules, alternating_employees)
-add_consecutive_working_constraints(model, x, shift_to_int, employees, num_weeks, days_per_week, previous_state)
-
-solver = cp_model.CpSolver()
-solver.parameters.random_seed = int(datetime.datetime.now().timestamp())
-status = solver.Solve(model)
-
-def build_schedule(solver, x, num_weeks, days_per_week, employees, int_to_shift):
+        allowed = allowed_shifts_by_emp[emp]
+        for w in range(num_weeks):
+            for d in range(days_per_week):
+                cell = []
+                for s in shift_values:
+                    if s in allowed:
+                        name = f"is_shift[{w},{d},{e},{s}]"
+                        if name not in index_by_name:
+                            return None
+                        is_shift[w, d, e, s] = model.GetBoolVarFromProtoIndex(index_by_name[name])
+                    else:
+                        is_shift[w, d, e, s] = zero
+                    cell.append(is_shift[w, d, e, s])
+                x[w, d, e] = cp_model.LinearExpr.WeightedSum(cell, shift_values)
+                work[w, d, e] = cp_model.LinearExpr.Sum([is_shift[w, d, e, s] for s in working_values])
+    return model, x, is_shift, work
+
+def add_consecutive_working_constraints(model, is_shift, shift_to_int, employees, num_weeks, days_per_week, previous_state):
+    total_days = num_weeks * days_per_week
+    max_consecutive = 6
+    # A cell is a rest day when its D/O or H indicator is set. With one-hot cells,
+    # "at most max_consecutive worked days in a window of max_consecutive + 1"
+    # is the clause "some day in the window is a rest day".
+    rest_values = [shift_to_int["D/O"], shift_to_int["H"]]
+    for e, emp in enumerate(employees):
+        # Rest indicators per flat day index; no new variables.
+        flat_rest = [[is_shift[t // days_per_week, t % days_per_week, e, s] for s in rest_values] for t in range(total_days)]
+        # Days already worked at the end of the previous rota shorten the first window.
+        init = min(previous_state.get(emp, {}).get("consecutive", 0), max_consecutive)
+        first_window = max_consecutive + 1 - init
+        if init and first_window <= total_days:
+            model.AddBoolOr([lit for t in range(first_window) for lit in flat_rest[t]])
+        for t in range(total_days - max_consecutive):
+            model.AddBoolOr([lit for k in range(max_consecutive + 1) for lit in flat_rest[t + k]])
+
+def build_schedule(solver, is_shift, num_weeks, days_per_week, employees, int_to_shift):
+    # Read the whole solution vector once rather than calling solver.Value per cell;
+    # each cell's shift is the one whose indicator is set.
+    solution = solver.ResponseProto().solution
     schedule = {}
     for w in range(num_weeks):
         schedule[w] = {}
         for d in range(days_per_week):
             schedule[w][d] = {}
             for e, emp in enumerate(employees):
-                val = solver.Value(x[w, d, e])
-                schedule[w][d][emp] = int_to_shift[val]
+                for s, shift in int_to_shift.items():
+                    if solution[is_shift[w, d, e, s].Index()]:
+                        schedule[w][d][emp] = shift
+                        break
     return schedule
 
 def write_output_csv(schedule, output_file, start_date, num_weeks, days_per_week, employees, reserve_employees):
     os.makedirs(os.path.dirname(output_file), exist_ok=True)
-    with open(output_file, mode="w", newline="") as csvfile:
+    # Header labels for every day of the rota, formatted once up front.
+    labels = [(start_date + datetime.timedelta(days=i)).strftime('%a %d/%m') for i in range(num_weeks * days_per_week)]
+    # Write to a temporary file and rename it into place, so an interrupted run never
+    # leaves a partial rota behind for load_last_rota to pick up next time.
+    tmp_file = output_file + ".tmp"
+    with open(tmp_file, mode="w", newline="") as csvfile:
         writer = csv.writer(csvfile)
+        blank_day_off = [emp in reserve_employees for emp in employees]
         for w in range(num_weeks):
-            week_start = start_date + datetime.timedelta(days=w * days_per_week)
-            header = ["Name"] + [f"{(week_start + datetime.timedelta(days=d)).strftime('%a %d/%m')}" for d in range(days_per_week)]
-            writer.writerow(header)
-            for e, emp in enumerate(employees):
-                row = [emp]
-                for d in range(days_per_week):
-                    shift_str = schedule[w][d][emp]
-                    if emp in reserve_employees and shift_str == "D/O":
-                        row.append("")
-                    else:
-                        row.append(shift_str)
-                writer.writerow(row)
-            writer.writerow([])
+            days = schedule[w]
+            header = ["Name"] + labels[w * days_per_week:(w + 1) * days_per_week]
+            rows = [[emp] + ["" if blank and days[d][emp] == "D/O" else days[d][emp] for d in range(days_per_week)]
+                    for emp, blank in zip(employees, blank_day_off)]
+            writer.writerows([header] + rows + [[]])
+    os.replace(tmp_file, output_file)
 
-global_temp = temporary_rules["Required"].get("Everyone", {})
-if "Start Date" in global_temp:
-    start_date = datetime.datetime.strptime(global_temp["Start Date"], "%Y/%m/%d")
-    out_date_str = start_date.strftime("%Y-%m-%d")
-else:
-    start_date = datetime.datetime.today()
+num_weeks = 4
+days_per_week = 7
+
+# Define the mapping between shift names and integer values.
+shift_to_int = {
+    "E": 0,    # Early
+    "M": 1,    # Middle
+    "L": 2,    # Late
+    "D/O": 3,  # Day Off
+    "H": 4     # Holiday
+}
+
+# Inverse mapping: useful for converting the solver’s output to shift names.
+int_to_shift = {v: k for k, v in shift_to_int.items()}
+
+def main():
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+
+    rules_filepath = os.path.join(script_dir, "Rules.json")
+    required_rules, preferred_rules, rules_data = load_rules(rules_filepath)
+    duty_managers = rules_data.get("employees-duty_manager", [])
+    reserve_employees = rules_data.get("employees-duty_manager-reserve", [])
+    employees = duty_managers + [emp for emp in reserve_employees if emp not in duty_managers]
+    emp_to_idx = {emp: e for e, emp in enumerate(employees)}
+
+    alternating_employees = []
+    if "Every other weekend off" in required_rules:
+        alternating_employees = required_rules["Every other weekend off"]
+
+    output_dir = os.path.join(script_dir, "output")
+    previous_state = load_last_rota(output_dir)
+    temp_filepath = os.path.join(script_dir, "Temporary Rules.json")
+    temporary_rules = load_temporary_rules(temp_filepath)
+
+    # Only the structural core is cached, so it stays valid while the
+    # rules, temporary rules and previous rota change from month to month.
+    allowed_shifts_by_emp = get_allowed_shifts(required_rules, employees, shift_to_int)
+    cache_key = model_cache_key(os.path.abspath(__file__), [num_weeks, days_per_week, employees, reserve_employees,
+                                                            {emp: sorted(allowed) for emp, allowed in allowed_shifts_by_emp.items()}])
+    cache_path = os.path.join(script_dir, ".cache", f"rota_core_{cache_key}.pb.txt")
+    cached = None
+    if os.path.exists(cache_path):
+        cached = load_cached_model(cache_path, num_weeks, days_per_week, employees, shift_to_int, allowed_shifts_by_emp)
+    if cached:
+        model, x, is_shift, work = cached
+    else:
+        model, x, is_shift, work = build_core_model(num_weeks, days_per_week, employees, shift_to_int, allowed_shifts_by_emp, reserve_employees)
+        save_model_cache(model, cache_path)
+
+    # Enforce required working days exactly (no slack) for duty managers and at most for reserves.
+    add_employee_specific_constraints(model, required_rules, employees, emp_to_idx, day_name_to_index, shift_to_int, is_shift, work, num_weeks, days_per_week, duty_managers, reserve_employees)
+    add_redundant_weekly_totals(model, required_rules, employees, work, num_weeks, days_per_week, duty_managers, reserve_employees)
+    add_temporary_constraints(model, is_shift, employees, emp_to_idx, temporary_rules, num_weeks, days_per_week, shift_to_int)
+    weekend_offsets = {}
+    for emp in alternating_employees:
+        weekend_offsets[emp] = 1 if previous_state.get(emp, {}).get("weekend_off", False) else 0
+    if alternating_employees:
+        enforce_strict_alternating_weekends(model, is_shift, shift_to_int, num_weeks, days_per_week, emp_to_idx, alternating_employees, weekend_offsets)
+    add_objective(model, is_shift, shift_to_int, num_weeks, days_per_week, employees, emp_to_idx, preferred_rules, alternating_employees)
+    add_consecutive_working_constraints(model, is_shift, shift_to_int, employees, num_weeks, days_per_week, previous_state)
+    symmetric_groups = find_interchangeable_groups(employees, required_rules, preferred_rules, temporary_rules, previous_state, duty_managers, reserve_employees, alternating_employees)
+    add_symmetry_breaking(model, x, num_weeks, days_per_week, symmetric_groups)
+
+    solver = cp_model.CpSolver()
+    # A fresh 31-bit seed each run; adjacent timestamps made poor, correlated seeds.
+    solver.parameters.random_seed = int.from_bytes(os.urandom(4), "little") & 0x7FFFFFFF
+    # Run the parallel portfolio on every core (or ROTA_WORKERS) and bound the runtime.
+    num_workers = os.cpu_count() or 8
+    workers_env = os.environ.get("ROTA_WORKERS")
+    if workers_env is not None:
+        try:
+            requested = int(workers_env)
+        except ValueError:
+            requested = 0
+        if requested > 0:
+            num_workers = requested
+        else:
+            print(f"Ignoring ROTA_WORKERS={workers_env!r}: expected a positive whole number. Using the CPU count ({num_workers}).")
+    solver.parameters.num_workers = num_workers
+    solver.parameters.linearization_level = 2
+    solver.parameters.optimize_with_core = True
+    solver.parameters.cp_model_presolve = True
+    solver.parameters.log_search_progress = os.environ.get("ROTA_DEBUG", "").strip().lower() in ("1", "true", "yes")
+    solver.parameters.max_time_in_seconds = 30.0
+    # Stop once the best rota is within 1% of the proven bound.
+    solver.parameters.relative_gap_limit = 0.01
+    apply_solver_overrides(solver, os.path.join(script_dir, "Solver Parameters.json"))
+    status = solver.Solve(model)
+
+    global_temp = temporary_rules["Required"].get("Everyone", {})
+    # Same start date as add_temporary_constraints: the configured one, or today if blank.
+    if global_temp.get("Start Date"):
+        start_date = parse_rule_date(global_temp["Start Date"])
+    else:
+        start_date = datetime.date.today()
     out_date_str = start_date.strftime("%Y-%m-%d")
 
-if status in (cp_model.OPTIMAL, cp_model.FEASIBLE):
-    schedule = build_schedule(solver, x, num_weeks, days_per_week, employees, int_to_shift)
-    output_file = os.path.join(script_dir, "output", f"Rota - {out_date_str}.csv")
-    write_output_csv(schedule, output_file, start_date, num_weeks, days_per_week, employees, reserve_employees)
-    print("Solution found. Wrote to:", os.path.abspath(output_file))
-else:
-    print("No solution found.")
+    if status in (cp_model.OPTIMAL, cp_model.FEASIBLE):
+        schedule = build_schedule(solver, is_shift, num_weeks, days_per_week, employees, int_to_shift)
+        output_file = os.path.join(script_dir, "output", f"Rota - {out_date_str}.csv")
+        write_output_csv(schedule, output_file, start_date, num_weeks, days_per_week, employees, reserve_employees)
+        print("Solution found. Wrote to:", os.path.abspath(output_file))
+    elif status == cp_model.INFEASIBLE:
+        print("No solution found: the rules contradict each other. Check Rules.json and Temporary Rules.json.")
+    elif status == cp_model.MODEL_INVALID:
+        print("No solution found: the solver rejected the model as invalid.")
+    else:
+        print(f"No solution found within the {solver.parameters.max_time_in_seconds:g} second time limit. "
+              "The rules may still be satisfiable; try running again or raising max_time_in_seconds in Solver Parameters.json.")
+
+if __name__ == "__main__":
+    main()